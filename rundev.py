@@ -2,15 +2,32 @@
 # Helpers to manager spawned processes.
 # In development, provides one stream listing all events.
 # In production, forwards process managements to supervisord.
-import argparse, os, tempfile, socket, json, fcntl, contextlib, subprocess, pipes, queue, atexit, threading, signal, sys, glob, pty, time, pwd
+import argparse, os, tempfile, socket, json, fcntl, contextlib, subprocess, shlex, queue, atexit, threading, signal, sys, itertools, time, pwd, selectors, shutil, http.client, xmlrpc.client
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # ---------- Common -----------
 
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj, indent=False):
+    # Returns bytes, so the result can be written to sockets and files directly.
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None).encode()
+
 def clear_env():
+    environ = dict(os.environ)
     env = {}
     for name in ['HOME', 'USER', 'LOGNAME']:
-        if name in os.environ:
-            env[name] = os.environ[name]
+        if name in environ:
+            env[name] = environ[name]
 
     env['LANG'] = 'en_US.UTF-8'
     env['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
@@ -18,11 +35,12 @@ def clear_env():
     os.environ.update(env)
 
 def parse_env(env):
+    environ = dict(os.environ) if env else {}
     d = {}
     for item in (env or []):
         value = item.split('=', 1)
         if len(value) == 1:
-            value = (value[0], os.environ[value[0]])
+            value = (value[0], environ[value[0]])
         d[value[0]] = value[1]
 
     return d
@@ -35,9 +53,17 @@ def setup_cg():
     global CG
     CG = '/sys/fs/cgroup/cpu'
 
-    if os.path.exists(CG + '/lxc/') and len(os.listdir(CG)) == 1:
-        # We are running inside LXC
-        CG = glob.glob(CG + '/lxc/*')[0]
+    if os.path.exists(CG + '/lxc/'):
+        with os.scandir(CG) as it:
+            only_lxc = len(list(itertools.islice(it, 2))) == 1 # don't list the whole directory
+
+        if only_lxc:
+            # We are running inside LXC
+            with os.scandir(CG + '/lxc') as it:
+                container = next(( entry.path for entry in it
+                                   if entry.is_dir() and not entry.name.startswith('.') ), None)
+            if container:
+                CG = container
 
     CG += '/rundev'
 
@@ -47,55 +73,96 @@ def setup_cg():
         subprocess.check_call(['sudo', 'mkdir', CG])
         subprocess.check_call(['sudo', 'chown', str(os.getuid()), CG])
 
+CG_TASKS_FD = None
+
 def add_to_cg():
     # Sometimes LXCFS (or cgroupfs?) perpetually returns 0 from os.write, hanging file.write function. We workaround this bug (?) by reopening FD.
-    for i in range(30):
-        with open(CG + '/tasks', 'a') as f:
-            s = (str(os.getpid()) + '\n').encode()
-            result = os.write(f.fileno(), s)
-            if result == len(s):
-                return
-
-    raise OSError('could not add task to cgroup (returned %d)' % result)
+    global CG_TASKS_FD
+    remaining = (str(os.getpid()) + '\n').encode()
+    attempts = 0
+    while remaining:
+        if CG_TASKS_FD is None:
+            CG_TASKS_FD = os.open(CG + '/tasks', os.O_WRONLY | os.O_CLOEXEC)
+        result = os.write(CG_TASKS_FD, remaining)
+        if result:
+            # partial write is fine, continue with the rest
+            remaining = remaining[result:]
+            continue
+
+        attempts += 1
+        if attempts == 30:
+            raise OSError('could not add task to cgroup (returned %d)' % result)
+
+        os.close(CG_TASKS_FD)
+        CG_TASKS_FD = None
+        time.sleep(0.01)
 
 class PtyPopen():
-    # Runs children in a new PTY.
-    def __init__(self, args, environ, chdir):
+    # Runs children in a new PTY (or with output going to a pipe if use_pty is False).
+    # Uses posix_spawn, so the (possibly large) server process is never forked.
+    def __init__(self, args, environ, chdir, use_pty=True):
         self.args = args
         self.environ = environ
         self.chdir = chdir
-        pid, master = pty.fork()
 
-        if pid == 0:
-            add_to_cg()
-            try:
-                self._child()
-            except:
-                traceback.print_exc()
-            finally:
-                os._exit(0)
+        args = [ str(arg) for arg in args ]
+        env = dict(os.environ)
+        env.update({ k: str(v) for k, v in dict(environ).items() })
+        if chdir:
+            # posix_spawn can't change directory, let the shell do it just before exec
+            args = ['/bin/sh', '-c', 'cd "$0" && exec "$@"', str(chdir)] + args
+
+        if use_pty:
+            master, slave = os.openpty()
+            # opening the slave after setsid makes it the controlling terminal
+            file_actions = [(os.POSIX_SPAWN_OPEN, 0, os.ttyname(slave), os.O_RDWR, 0),
+                            (os.POSIX_SPAWN_DUP2, 0, 1),
+                            (os.POSIX_SPAWN_DUP2, 0, 2)]
         else:
-            self.pid = pid
-            self.stdout = os.fdopen(master, 'rb', 0)
+            master, slave = os.pipe()
+            file_actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                            (os.POSIX_SPAWN_DUP2, slave, 1),
+                            (os.POSIX_SPAWN_DUP2, slave, 2)]
+
+        try:
+            self.pid = os.posix_spawn(which(env.get('PATH', ''), args[0]), args, env,
+                                      file_actions=file_actions, setsid=True,
+                                      setsigdef=[signal.SIGPIPE])
+        except OSError:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+
+        # openpty and pipe fds are not inherited by later children, we read master from the selector loop.
+        self.master = master
+        os.set_blocking(master, False)
+
+def read_cg_tasks():
+    # DevServer itself runs in the cgroup, so that children are spawned into it
+    # A new fd on every call: cgroupfs keeps serving the pid list snapshotted when an fd was first read.
+    own_tasks = os.listdir('/proc/self/task')
+    fd = os.open(CG + '/tasks', os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        data = b''
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk: break
+            data += chunk
+    finally:
+        os.close(fd)
 
-    def _child(self):
-        for k, v in self.environ:
-            os.environ[k] = v
-        if self.chdir:
-            os.chdir(self.chdir)
-        os.execvp(self.args[0], self.args)
+    return [ int(pid) for pid in data.split()
+             if pid.decode() not in own_tasks ]
 
 def kill_cg():
     for i in range(5):
         try:
-            tasks = open(CG + '/tasks').read().split()
+            tasks = read_cg_tasks()
         except OSError:
             return
 
-        tasks = [ pid for pid in tasks
-                  if int(pid) != os.getpid() ]
-
-        print('[Killing tasks: %s]' % ' '.join(tasks))
+        print('[Killing tasks: %s]' % ' '.join(map(str, tasks)))
 
         if i == 0:
             sig = 15
@@ -103,8 +170,28 @@ def kill_cg():
             sig = 9
 
         if not tasks: break
-        subprocess.call(['sudo', 'kill', '-%d' % sig] + tasks)
-        time.sleep(0.3)
+
+        denied = []
+        for pid in tasks:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                denied.append(str(pid))
+
+        if denied:
+            # e.g. children that changed user
+            subprocess.call(['sudo', 'kill', '-%d' % sig] + denied)
+
+        deadline = time.monotonic() + 0.3
+        while time.monotonic() < deadline:
+            time.sleep(0.01)
+            try:
+                if not read_cg_tasks():
+                    break
+            except OSError:
+                return
 
 class colors:
     gray = '\033[37m'
@@ -112,46 +199,206 @@ class colors:
     bg_red = '\033[101m'
     reset = '\033[0m'
 
+RESET_BYTES = colors.reset.encode()
+
+PARTIAL_LINE_TIMEOUT = 0.5
+OUTPUT_BATCH_SIZE = 64
+OUTPUT_QUEUE_HIGH = 1000
+OUTPUT_QUEUE_LOW = 100
+CONTROL_BUFFER_SIZE = 4096
+CONTROL_MAX_REQUEST = 4 * 1024 * 1024
+
 class DevServer():
     def __init__(self):
-        self.output_queue = queue.Queue(100)
+        self.output_queue = queue.SimpleQueue()
         self.children = {}
+        self.pids = {}
+        self.partial = {}
+        self.paused = {}
+        self.prefix_cache = {}
+        self.selector = selectors.DefaultSelector()
+
+    def accept(self, sock, state):
+        try:
+            conn, addr = sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        state = {'buf': bytearray(CONTROL_BUFFER_SIZE), 'pos': 0}
+        self.selector.register(conn, selectors.EVENT_READ, (self.control, state))
+
+    def control(self, sock, state):
+        buf = state['buf']
+        pos = state['pos']
+        try:
+            n = sock.recv_into(memoryview(buf)[pos:])
+        except BlockingIOError:
+            return
+        except OSError:
+            n = 0 # client went away, e.g. with our confirmation still unread
+        if not n:
+            self.close_control(sock)
+            return
+
+        # Connections are kept open by `add` and carry length-prefixed JSON requests.
+        pos += n
+        start = 0
+        while pos - start >= 4:
+            length = int.from_bytes(buf[start:start + 4], 'little')
+            if length > CONTROL_MAX_REQUEST:
+                self.output_queue.put(('rundev', ('invalid request: %d bytes is too large\n' % length).encode()))
+                self.close_control(sock)
+                return
+
+            end = start + 4 + length
+            if end > pos:
+                break
+
+            try:
+                self.spawn(json_loads(buf[start + 4:end]))
+            except Exception as e:
+                # bad request shouldn't bring down the whole console
+                self.output_queue.put(('rundev', ('invalid request: %r\n' % e).encode()))
+                self.close_control(sock)
+                return
+
+            try:
+                sock.sendall(b'A') # confirmation
+            except OSError:
+                self.close_control(sock)
+                return
+            start = end
+
+        if start:
+            buf[:pos - start] = buf[start:pos]
+            pos -= start
+
+        if pos >= 4:
+            # make room for the rest of a large request (its size was checked above)
+            size = 4 + int.from_bytes(buf[:4], 'little')
+            if size > len(buf):
+                buf.extend(bytearray(size - len(buf)))
+
+        state['pos'] = pos
 
-    def child(self, sock):
-        info = json.loads(sock.makefile().readline())
+    def close_control(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+
+    def spawn(self, info):
         name = info['name']
         if info['subname']:
             name = info['subname'] + '/' + name
 
         if name in self.children:
-            sock.sendall(b'A') # confirmation
-            self.output_queue.put((name, 'child already running'))
+            self.output_queue.put((name, b'child already running\n'))
+            return
+
+        try:
+            child = PtyPopen(info['command'], environ=info['env'],
+                             chdir=info['chdir'], use_pty=info.get('pty', True))
+        except (OSError, TypeError, ValueError) as e:
+            self.output_queue.put((name, ('failed to start: %s\n' % e).encode()))
             return
 
-        child = PtyPopen(info['command'], environ=info['env'],
-                         chdir=info['chdir'])
         self.children[name] = child
         if name != '_initial':
             msg = ('started: %s\n' % ' '.join(map(str, info['command'])))
             self.output_queue.put((name, msg.encode('utf8')))
 
-        sock.sendall(b'A') # confirmation
+        state = {'name': name, 'info': info, 'child': child, 'tail': bytearray(),
+                 'eof': False, 'status': None}
+        self.pids[child.pid] = state
+        self.selector.register(child.master, selectors.EVENT_READ, (self.child_output, state))
+
+    def child_output(self, fd, state):
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        name = state['name']
+        if data:
+            tail = state['tail']
+            tail += data
+            lines = tail.split(b'\n')
+            state['tail'] = lines.pop()
+            for line in lines:
+                self.output_queue.put((name, bytes(line) + b'\n'))
+
+            if not state['tail']:
+                self.partial.pop(name, None)
+            elif name not in self.partial:
+                self.partial[name] = (time.monotonic(), state)
+            return
+
+        self.selector.unregister(fd)
+        os.close(fd)
+        self.partial.pop(name, None)
+        if state['tail']:
+            self.output_queue.put((name, bytes(state['tail'])))
+        state['eof'] = True
+        self.child_done(state)
+
+    def flush_partial(self):
+        # Show lines without newline (e.g. prompts) if nothing follows them for a while.
+        now = time.monotonic()
+        for name, (since, state) in list(self.partial.items()):
+            if now - since >= PARTIAL_LINE_TIMEOUT:
+                del self.partial[name]
+                self.output_queue.put((name, bytes(state['tail']) + b'\n'))
+                state['tail'] = bytearray()
+
+    def wakeup(self, fd, state):
+        # Signal arrived (see signal.set_wakeup_fd), look for exited children.
+        try:
+            os.read(fd, 4096)
+        except BlockingIOError:
+            pass
+        self.reap()
 
+    def reap(self):
         while True:
             try:
-                line = child.stdout.readline()
-            except OSError:
-                break
-            if not line:
-                break
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
 
-            self.output_queue.put((name, line))
+            state = self.pids.pop(pid, None)
+            if state:
+                state['status'] = status
+                self.child_done(state)
 
-        _, status = os.waitpid(child.pid, 0)
+    def child_done(self, state):
+        # Child is finished once it exited and all of its output was read.
+        if not state['eof'] or state['status'] is None:
+            return
 
-        exit_info = ('exited with status %d' % status) if info['oneshot'] else (colors.bg_red + '!!! PROCESS EXITED !!!' + colors.reset)
-        del self.children[name]
+        status = state['status']
+        name = state['name']
+        exit_info = ('exited with status %d' % status) if state['info']['oneshot'] else (colors.bg_red + '!!! PROCESS EXITED !!!' + colors.reset)
+        # queue the message first, so output_handler can't see no children and an empty queue in between
         self.output_queue.put((name, exit_info.encode() + b'\n'))
+        del self.children[name]
+        if not self.children:
+            self.output_queue.put(None) # wake up output_handler, it may have seen the message before the del
+
+    def throttle(self):
+        # Stop reading children while output_handler is behind (slow terminal, Ctrl-S, ...), so the queue stays bounded.
+        queued = self.output_queue.qsize()
+        if queued > OUTPUT_QUEUE_HIGH:
+            for key in list(self.selector.get_map().values()):
+                if key.data[0] == self.child_output:
+                    self.selector.unregister(key.fileobj)
+                    self.paused[key.fileobj] = key.data
+        elif self.paused and queued < OUTPUT_QUEUE_LOW:
+            for fd, data in self.paused.items():
+                self.selector.register(fd, selectors.EVENT_READ, data)
+            self.paused = {}
 
     def finish(self):
         kill_cg()
@@ -159,25 +406,51 @@ class DevServer():
 
     def output_handler(self):
         max_name_length = 10
+        drained = True
         while True:
-            name, line = self.output_queue.get()
-            max_name_length = max(max_name_length, len(name))
-            sys.stdout.buffer.write(((colors.gray + '[%s] ' + colors.reset) % (name.ljust(max_name_length))).encode())
-            sys.stdout.buffer.write(line)
-            sys.stdout.buffer.write(colors.reset.encode())
+            # Drain whatever is queued, so bursts of output end up in a single write.
+            batch = [self.output_queue.get()] if drained else []
+            drained = False
+            while len(batch) < OUTPUT_BATCH_SIZE:
+                try:
+                    batch.append(self.output_queue.get_nowait())
+                except queue.Empty:
+                    drained = True
+                    break
+
+            out = bytearray()
+            for item in batch:
+                if item is None:
+                    continue
+                name, line = item
+                if len(name) > max_name_length:
+                    max_name_length = len(name)
+                    self.prefix_cache.clear()
+
+                prefix = self.prefix_cache.get((name, max_name_length))
+                if prefix is None:
+                    prefix = (colors.gray + '[' + name.ljust(max_name_length) + '] ' + colors.reset).encode()
+                    self.prefix_cache[(name, max_name_length)] = prefix
+
+                out += prefix
+                out += line
+                out += RESET_BYTES
+            sys.stdout.buffer.write(out)
             sys.stdout.buffer.flush()
 
-            if len(self.children) == 0 and self.output_queue.qsize() == 0:
+            if not self.children and self.output_queue.empty():
                 print('No more running processes, exiting.')
                 self.finish()
 
     def main(self, command, env):
         setup_cg()
+        add_to_cg()
         tmp_dir = tempfile.mkdtemp()
         socket_path = tmp_dir + '/rundev.socket'
-        sock = socket.socket(socket.AF_UNIX)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
         sock.bind(socket_path)
         sock.listen(5)
+        sock.setblocking(False)
 
         clear_env()
         os.environ['RUNDEV_SOCKET'] = socket_path
@@ -198,14 +471,36 @@ class DevServer():
 
         signal.signal(signal.SIGINT, lambda *_: self.finish())
 
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGCHLD, lambda *_: None)
+
+        self.selector.register(sock, selectors.EVENT_READ, (self.accept, None))
+        self.selector.register(wakeup_r, selectors.EVENT_READ, (self.wakeup, None))
+
         while True:
-            child, addr = sock.accept()
-            threading.Thread(target=self.child, args=[child]).start()
+            timeout = PARTIAL_LINE_TIMEOUT if self.partial else None
+            if self.paused:
+                timeout = 0.05 # poll until output_handler catches up
+            for key, _ in self.selector.select(timeout=timeout):
+                callback, state = key.data
+                try:
+                    callback(key.fileobj, state)
+                except Exception as e:
+                    # one bad fd shouldn't take down the whole console
+                    self.output_queue.put(('rundev', ('error handling fd %d: %r\n' % (key.fd, e)).encode()))
+                    self.selector.unregister(key.fileobj)
+            self.flush_partial()
+            self.throttle()
 
 # --------- Production -----------
 
 runtime_dir = None
 
+JOURNAL_COMPACT_SIZE = 64 * 1024
+
 def check_runtime_dir(create=False):
     global runtime_dir
     subname = os.environ.get('RUNDEV_SUBNAME', 'rundev')
@@ -234,23 +529,23 @@ def which(path, program):
     fpath, fname = os.path.split(program)
     if fpath:
         return program
-    else:
-        for path in path.split(':'):
-            path = path.strip('"')
-            if not path: continue
-            exe_file = os.path.join(path, program)
-            if os.path.isfile(exe_file):
-                return exe_file
 
-    return program
+    path = ':'.join( entry.strip('"') for entry in path.split(':')
+                     if entry.strip('"') )
+    return shutil.which(program, path=path) or program
+
+def supervisor_quote(s):
+    if s.isascii() and s.isalnum():
+        return s # shlex.quote would return it unchanged
+    s = shlex.quote(s)
+    return s.replace('%', '%%') if '%' in s else s
 
 def create_supervisor_config():
-    with open(runtime_dir + '/processes.json', 'r') as f:
-        info = json.loads(f.read())
+    info = load_processes()
 
-    config = '''
+    parts = [f'''
 [supervisord]
-childlogdir={logdir}
+childlogdir={info['logdir']}
 
 [unix_http_server]
 file={runtime_dir}/supervisord.sock
@@ -261,10 +556,12 @@ supervisor.rpcinterface_factory = supervisor.rpcinterface:make_main_rpcinterface
 
 [supervisorctl]
 serverurl=unix://{runtime_dir}/supervisord.sock
-'''.format(runtime_dir=runtime_dir, logdir=info['logdir'])
+''']
 
-    def supervisor_quote(s):
-        return pipes.quote(s).replace('%', '%%')
+    # Programs and users are usually shared by many processes.
+    programs = {}
+    homes = {}
+    sq = supervisor_quote # local name, it's called for every config line
 
     for process in info['processes'].values():
         environ = dict(info['env'])
@@ -275,40 +572,105 @@ serverurl=unix://{runtime_dir}/supervisord.sock
         if environ.get('EXTPATH'):
             path = environ['EXTPATH'] + ':' + path
 
-        command[0] = which(path, command[0]) # supervisord doesn't handle PATH properly
-        config += '''
-[program:{name}]
-command={command}
+        if (path, command[0]) not in programs:
+            programs[(path, command[0])] = which(path, command[0]) # supervisord doesn't handle PATH properly
+        command[0] = programs[(path, command[0])]
+        parts.append(f'''
+[program:{process['name']}]
+command={' '.join(map(sq, command))}
 redirect_stderr=True
-'''.format(name=process['name'],
-           command=' '.join(map(supervisor_quote, command)))
+''')
         if process['oneshot']:
-            config += 'startsecs=0\nautorestart=false\n'
+            parts.append('startsecs=0\nautorestart=false\n')
 
         if process['chdir']:
-            config += 'directory=%s\n' % supervisor_quote(process['chdir'])
+            parts.append(f'directory={sq(process["chdir"])}\n')
 
         for k, v in environ.items():
-            config += 'environment=%s=%s\n' % (supervisor_quote(k), supervisor_quote(v))
+            parts.append(f'environment={sq(k)}={sq(v)}\n')
 
         if 'EXTPATH' in environ:
-            config += 'environment=PATH=%s\n' % supervisor_quote(path)
+            parts.append(f'environment=PATH={sq(path)}\n')
 
-        if process.get('user'):
-            config += 'user=%s\n' % supervisor_quote(process['user'])
-            config += 'environment=HOME=%s\n' % supervisor_quote(pwd.getpwnam(process['user']).pw_dir)
+        user = process.get('user')
+        if user:
+            if user not in homes:
+                homes[user] = pwd.getpwnam(user).pw_dir
+            parts.append(f'user={sq(user)}\n')
+            parts.append(f'environment=HOME={sq(homes[user])}\n')
 
     with open(runtime_dir + '/supervisord.conf', 'w') as f:
-        f.write(config)
+        f.write(''.join(parts))
 
-def save_process(process_info):
-    with open(runtime_dir + '/processes.json', 'r') as f:
-        info = json.loads(f.read())
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o600)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+
+def parse_journal(data):
+    # Returns records and the length of the valid prefix (a crash may leave a torn record at the end).
+    records = []
+    pos = 0
+    while pos + 4 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'little')
+        end = pos + 4 + length
+        if length == 0 or end > len(data):
+            break
+        records.append(data[pos + 4:end])
+        pos = end
+
+    return records, pos
+
+def load_processes():
+    # processes.json is a snapshot, processes.journal contains processes saved after it was written.
+    with open(runtime_dir + '/processes.json', 'rb') as f:
+        info = json_loads(f.read())
 
-    info['processes'][process_info['name']] = process_info
+    try:
+        with open(runtime_dir + '/processes.journal', 'rb') as f:
+            records, _ = parse_journal(f.read())
+    except FileNotFoundError:
+        records = []
+
+    for record in records:
+        process_info = json_loads(record)
+        info['processes'][process_info['name']] = process_info
+
+    return info
 
-    with open(runtime_dir + '/processes.json', 'w') as f:
-        f.write(json.dumps(info, indent=2))
+def write_processes(info):
+    # If we crash before the journal is removed, replaying it over the new snapshot is harmless.
+    write_atomic(runtime_dir + '/processes.json', json_dumps(info, indent=True))
+    try:
+        os.unlink(runtime_dir + '/processes.journal')
+    except FileNotFoundError:
+        pass
+
+def save_process(process_info):
+    record = json_dumps(process_info)
+    fd = os.open(runtime_dir + '/processes.journal',
+                 os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_CLOEXEC, 0o600)
+    with open(fd, 'r+b') as f:
+        f.seek(0)
+        data = f.read()
+        _, valid = parse_journal(data)
+        if valid != len(data):
+            f.truncate(valid)
+
+        f.write(len(record).to_bytes(4, 'little') + record)
+        f.flush()
+        os.fsync(f.fileno())
+        size = f.tell()
+
+    if size > JOURNAL_COMPACT_SIZE:
+        write_processes(load_processes())
 
 def start_supervisor():
     if not os.path.exists(runtime_dir + '/supervisord.sock'):
@@ -316,14 +678,68 @@ def start_supervisor():
 
         subprocess.check_call(['supervisord', '-c', runtime_dir + '/supervisord.conf'])
 
+class UnixStreamHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        self.sock.connect(self.socket_path)
+
+class UnixStreamTransport(xmlrpc.client.Transport):
+    # XML-RPC over supervisord's unix socket.
+    def __init__(self, socket_path):
+        super().__init__()
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        return UnixStreamHTTPConnection(self.socket_path)
+
+SUPERVISOR_FAILED = 30 # supervisor.xmlrpc.Faults.FAILED
+
+def update_supervisor():
+    # Same as `supervisorctl reread` followed by `supervisorctl update`, without spawning supervisorctl twice.
+    proxy = xmlrpc.client.ServerProxy(
+        'http://localhost', transport=UnixStreamTransport(runtime_dir + '/supervisord.sock'))
+    supervisor = proxy.supervisor
+    added, changed, removed = supervisor.reloadConfig()[0]
+
+    changes = {}
+    changes.update(dict.fromkeys(added, 'available'))
+    changes.update(dict.fromkeys(changed, 'changed'))
+    changes.update(dict.fromkeys(removed, 'disappeared'))
+    for name in sorted(changes):
+        print('%s: %s' % (name, changes[name]))
+    if not changes:
+        print('No config updates to processes')
+
+    for name in removed:
+        results = supervisor.stopProcessGroup(name)
+        print('%s: stopped' % name)
+        if any( result['status'] == SUPERVISOR_FAILED for result in results ):
+            print('%s: has problems; not removing' % name)
+            continue
+        supervisor.removeProcessGroup(name)
+        print('%s: removed process group' % name)
+
+    for name in changed:
+        supervisor.stopProcessGroup(name)
+        print('%s: stopped' % name)
+        supervisor.removeProcessGroup(name)
+        supervisor.addProcessGroup(name)
+        print('%s: updated process group' % name)
+
+    for name in added:
+        supervisor.addProcessGroup(name)
+        print('%s: added process group' % name)
+
 def add_process(info):
     check_runtime_dir(create=False)
     with lock():
         save_process(info)
-        ctl = ['supervisorctl', '-c', runtime_dir + '/supervisord.conf']
         create_supervisor_config()
-    subprocess.check_call(ctl + ['reread'])
-    subprocess.check_call(ctl + ['update'])
+    update_supervisor()
 
 def run_ctl(command):
     check_runtime_dir(create=False)
@@ -340,18 +756,40 @@ def init_production(logdir, env):
         pass
 
     with lock():
-        with open(runtime_dir + '/processes.json', 'w') as f:
-            f.write(json.dumps({
-                'processes': {},
-                'env': parse_env(env),
-                'logdir': logdir
-            }))
+        write_processes({
+            'processes': {},
+            'env': parse_env(env),
+            'logdir': logdir
+        })
 
         start_supervisor()
 
 # ---------- Commands -------------
 
-def add(name, command, env={}, user=None, oneshot=False, chdir=None):
+RUNDEV_SOCK = None
+RUNDEV_LOCK = threading.Lock()
+
+def send_to_devserver(info):
+    # Reuses one connection per process, so scripts calling `add` in a loop don't reconnect each time.
+    global RUNDEV_SOCK
+    payload = json_dumps(info)
+    with RUNDEV_LOCK:
+        if RUNDEV_SOCK is None or RUNDEV_SOCK[0] != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+            sock.connect(os.environ['RUNDEV_SOCKET'])
+            RUNDEV_SOCK = (os.getpid(), sock)
+
+        sock = RUNDEV_SOCK[1]
+        try:
+            sock.sendall(len(payload).to_bytes(4, 'little') + payload)
+            if not sock.recv(1):
+                raise OSError('development console closed the connection')
+        except OSError:
+            sock.close()
+            RUNDEV_SOCK = None
+            raise
+
+def add(name, command, env={}, user=None, oneshot=False, chdir=None, use_pty=True):
     info = {
         'name': name,
         'command': command,
@@ -359,15 +797,12 @@ def add(name, command, env={}, user=None, oneshot=False, chdir=None):
         'chdir': chdir,
         'oneshot': oneshot,
         'user': user,
+        'pty': use_pty,
     }
     if 'RUNDEV_SOCKET' in os.environ:
         # development, send arguments to development console
-        sock = socket.socket(socket.AF_UNIX)
         info['subname'] = os.environ.get('RUNDEV_SUBNAME')
-        sock.connect(os.environ['RUNDEV_SOCKET'])
-        sock.sendall((json.dumps(info) + '\n').encode())
-        sock.recv(1)
-        sock.close()
+        send_to_devserver(info)
     else:
         add_process(info)
 
@@ -408,6 +843,9 @@ def main():
                            help='Is it normal for this process to exit?')
     subparser.add_argument('--user',
                            help='Change user before executing')
+    subparser.add_argument('--no-pty',
+                           action='store_true',
+                           help='Don\'t run the process in a PTY (development only)')
 
     ns = parser.parse_args()
     if ns.action == 'dev':
@@ -419,7 +857,7 @@ def main():
         if ns.command:
             os.execvp(ns.command[0], ns.command)
     elif ns.action == 'add':
-        add(ns.name, ns.command, oneshot=ns.oneshot, user=ns.user)
+        add(ns.name, ns.command, oneshot=ns.oneshot, user=ns.user, use_pty=not ns.no_pty)
     else:
         parser.print_usage()
 